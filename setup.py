@@ -1,3 +1,7 @@
+import os
+import shutil
+import sys
+
 from setuptools import setup
 
 
@@ -6,6 +10,38 @@ def get_requirements():
         return [line.strip() for line in f if line.strip()]
 
 
+def get_ext_modules():
+    """
+    Compile the module with mypyc when PERDICT_MYPYC=1 is set, otherwise install it as pure Python.
+
+    To run the tests against the compiled module, build it next to the sources with
+    `PERDICT_MYPYC=1 python setup.py build_ext --inplace` and run pytest as usual. Deleting
+    src/*.so goes back to the pure Python module.
+    """
+    if os.environ.get('PERDICT_MYPYC') != '1':
+        return []
+
+    from mypy.version import __version__ as mypy_version
+    from mypyc.build import mypycify
+
+    # Older mypyc compiles PerDict as a native class, ignoring @mypyc_attr(native_class=False)
+    if tuple(int(part) for part in mypy_version.split('.')[:2]) < (1, 16):
+        raise RuntimeError(f"PERDICT_MYPYC=1 needs mypy 1.16 or later, found {mypy_version}")
+
+    if '--inplace' in sys.argv:
+        # Compiled as src.perdict, the module the tests import
+        return mypycify([os.path.join('src', 'perdict.py')])
+
+    # mypyc names modules after their package directories, so the sources are staged under a
+    # directory named like the installed package instead of 'src'
+    stage = os.path.join('build', 'mypyc-src', 'perdict')
+    os.makedirs(stage, exist_ok=True)
+    for name in ('__init__.py', 'perdict.py'):
+        shutil.copy(os.path.join('src', name), stage)
+
+    return mypycify([os.path.join(stage, 'perdict.py')])
+
+
 setup(
     name='perdict',
     version='0.1.0',
@@ -14,5 +50,7 @@ setup(
     packages=['perdict'],
     package_dir={'perdict': 'src'},
     install_requires=get_requirements(),
+    extras_require={'orjson': ['orjson'], 'msgpack': ['msgpack']},
+    ext_modules=get_ext_modules(),
     package_data={'': ['license']}
 )
@@ -1,23 +1,303 @@
+import atexit
+import hashlib
 import json
+import mmap
+import os
+import threading
+import time
+import traceback
+import weakref
+import zlib
+from contextlib import contextmanager
 from pathlib import Path
-from typing import TypeVar, Any
+from typing import TypeVar, Any, BinaryIO, Iterator, Optional, Union
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore[assignment]
+
+try:
+    import msgpack  # type: ignore
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    from mypy_extensions import mypyc_attr
+except ImportError:
+    def mypyc_attr(*attrs: str, **kwattrs: Any) -> Any:  # type: ignore[misc]
+        return lambda cls: cls
 
 _KT = TypeVar("_KT")
 _VT = TypeVar("_VT")
 
+# Looked up once so the overridden methods call the dict implementations without resolving
+# them on the `dict` type every time
+_dict_getitem = dict.__getitem__
+_dict_setitem = dict.__setitem__
+_dict_delitem = dict.__delitem__
+_dict_update = dict.update
+_dict_pop = dict.pop
+_dict_popitem = dict.popitem
+_dict_clear = dict.clear
+
+_AUTOSAVE_MODES = (True, False, 'immediate', 'batched', 'async')
+
+# The write-ahead log is never compacted below this size, so small dictionaries are not
+# rewritten after every few operations.
+_COMPACT_MIN_SIZE = 64 * 1024
+
+# Without `durable`, the write-ahead log is still synced after this many bytes, so the OS never
+# has a large backlog of dirty pages to write back at once.
+_LOG_BYTES_PER_SYNC = 256 * 1024
+
+# JSON files larger than this are parsed straight from a memory map instead of being read
+# into a bytes object first.
+_MMAP_MIN_SIZE = 64 * 1024
+
+# Fallback encoder when orjson is not installed. It is built once, writes compact separators and
+# raw UTF-8 like orjson, and skips the circular reference check.
+_json_encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, check_circular=False).encode
+
+# Keeps os.write from translating newlines on Windows
+_O_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+def _dumps(obj: Any) -> bytes:
+    """
+    Serialize an object to JSON bytes, using orjson when it is installed.
+
+    orjson writes NaN and infinities as null, while the json module keeps them.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. integers wider than 64 bits, which the json module still handles
+            pass
+
+    try:
+        return _json_encode(obj).encode()
+    except UnicodeEncodeError:
+        # Lone surrogates can only be written escaped
+        return json.dumps(obj).encode()
+
+
+def _loads(data: Union[bytes, memoryview]) -> Any:
+    """
+    Deserialize JSON bytes, using orjson when it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            # e.g. NaN or Infinity written by the json module
+            pass
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+
+    return json.loads(data)
+
+
+def _msgpack_dumps(obj: Any) -> bytes:
+    """
+    Serialize an object to MessagePack bytes.
+    """
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_loads(data: Union[bytes, memoryview]) -> Any:
+    """
+    Deserialize MessagePack bytes, allowing non-string keys.
+    """
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+# Serializer and deserializer for each supported file format
+_FORMATS = {
+    'json': (_dumps, _loads),
+    'msgpack': (_msgpack_dumps, _msgpack_loads),
+}
+
+# Files with these extensions default to the MessagePack format
+_MSGPACK_SUFFIXES = ('.mpk', '.msgpack')
+
+# Extension of the shard files for each file format
+_SHARD_SUFFIXES = {
+    'json': '.json',
+    'msgpack': '.mpk',
+}
+
+
+def _digest(buf: Union[bytes, memoryview]) -> bytes:
+    """
+    Return a short fingerprint of a serialized dictionary.
+    """
+    return hashlib.blake2b(buf, digest_size=16).digest()
+
+
+def _shard_of(key: Any, shards: int) -> int:
+    """
+    Return the index of the shard a key is stored in.
+
+    The key is hashed in the form it takes as a JSON object key, so it maps to the same shard
+    after being read back as a string, and with CRC-32 rather than hash(), which is randomized
+    per process for strings.
+    """
+    if isinstance(key, str):
+        text = key
+    elif key is True:
+        text = 'true'
+    elif key is False:
+        text = 'false'
+    elif key is None:
+        text = 'null'
+    else:
+        text = str(key)
+
+    return zlib.crc32(text.encode('utf-8', 'surrogatepass')) % shards
+
+
+def _write_all(fd: int, buf: bytes) -> None:
+    """
+    Write the whole buffer to a file descriptor, retrying after partial writes.
+    """
+    view = memoryview(buf)
+    while view:
+        # Kept out of the slice, which mypyc can evaluate twice
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _sync(fd: int) -> None:
+    """
+    Flush a file's data to stable storage.
+
+    On macOS fsync() only reaches the drive's cache, so F_FULLFSYNC is used instead. Elsewhere
+    fdatasync() is preferred over fsync() because it skips metadata such as access times.
+    """
+    if fcntl is not None and hasattr(fcntl, 'F_FULLFSYNC'):
+        fcntl.fcntl(fd, fcntl.F_FULLFSYNC)
+    elif hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
 
+
+# Live PerDict objects by id, flushed at exit. PerDict is unhashable like dict, so it cannot be
+# kept in a WeakSet.
+_instances: 'weakref.WeakValueDictionary[int, PerDict]' = weakref.WeakValueDictionary()
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    """
+    Flush every live PerDict that is autosaving at interpreter exit.
+
+    An error is reported without stopping the loop, so one failing dictionary does not cost the
+    others their unsaved changes.
+    """
+    for obj in list(_instances.values()):
+        if obj.autosave:
+            try:
+                obj.flush()
+            except Exception:
+                traceback.print_exc()
+
+
+def _write_in_background(ref: weakref.ref, wake: threading.Event) -> None:
+    """
+    Flush the referenced PerDict whenever it is woken, until it is closed or collected.
+
+    Only a weak reference is held between writes so the thread never keeps the dictionary alive.
+    """
+    while True:
+        wake.wait()
+        wake.clear()
+
+        obj = ref()
+        if obj is None or obj._writer is not threading.current_thread():
+            return
+
+        try:
+            obj.flush()
+        except Exception as e:
+            # Kept for the next change or close() to raise instead of ending the thread silently
+            obj._error = e
+        del obj
+
+
+def _get_path(self: 'PerDict') -> Path:
+    """
+    The path to the JSON file.
+    """
+    if self._path is None:
+        self._path = Path(self._path_str)
+    return self._path
+
+
+def _set_path(self: 'PerDict', path: Union[str, 'os.PathLike[str]']) -> None:
+    """
+    Move later saves to another JSON file.
+
+    Files kept open by `keep_open` and `wal` stay at the old path until `close()`.
+
+    Raises:
+        ValueError: If the dictionary is sharded.
+    """
+    if self.shards is not None:
+        raise ValueError("path cannot be changed when shards are used")
+
+    self._path = None
+    self._path_str = os.fspath(path)
+    self._tmp_path = self._path_str + '.tmp'
+    self._log_path = self._path_str + '.log'
+    # The new file does not hold the last saved contents yet
+    self._last_digest = None
+
+
+# A native mypyc class inherits the dealloc of dict, which neither clears weak references nor
+# frees the attributes, so PerDict is compiled as a regular class with compiled methods
+@mypyc_attr(native_class=False)
 class PerDict(dict):
     """
     A dictionary-like object that automatically saves its contents to a JSON file.
 
     Args:
         path (str): The path to the JSON file.
-        autosave (bool, optional): Whether to automatically save changes to the file (default is True).
+        autosave (bool | str, optional): When to save changes to the file (default is True).
+            True or 'immediate' saves after every change, 'batched' saves at most once per
+            `flush_interval` seconds, 'async' saves on a background thread without blocking the
+            caller and False only saves on `save()`, `flush()` or exit.
+        flush_interval (float, optional): Minimum number of seconds between batched saves (default is 1.0).
+        wal (bool, optional): Whether to append changes to a write-ahead log next to the JSON file
+            instead of rewriting the whole file on every save (default is False).
+        durable (bool, optional): Whether to sync every write to stable storage before returning,
+            so saved changes survive a power loss (default is False).
+        keep_open (bool, optional): Whether to keep the JSON file open and overwrite it in place
+            instead of replacing it on every save (default is False). This saves an open() and a
+            rename() per save, but a crash mid-write can leave the file truncated.
+        format (str, optional): The file format, 'json' or 'msgpack' (default is 'msgpack' for
+            '.mpk' and '.msgpack' files and 'json' otherwise). MessagePack needs the optional
+            msgpack package and roughly halves the file size for numeric data.
+        shards (int, optional): The number of files to spread the keys across (default is None,
+            which keeps everything in a single file). With shards, `path` is a directory of
+            '000.json', '001.json', ... files and a save only rewrites the files holding changed keys.
         **defaults: Default key-value pairs to initialize the dictionary.
 
     Attributes:
-        autosave (bool): Whether automatic saving is enabled.
-        path (Path): The path to the JSON file.
+        autosave (bool | str): The automatic saving mode.
+        flush_interval (float): Minimum number of seconds between batched saves.
+        durable (bool): Whether writes are synced to stable storage.
+        format (str): The file format.
+        shards (int | None): The number of shard files, or None if a single file is used.
+        path (Path): The path to the JSON file, or to the directory of shard files.
 
     Example:
         >>> obj = PerDict('file.json', x=5, y=6)
@@ -26,44 +306,396 @@ class PerDict(dict):
         >>> obj.z = 10  # Add or modify dictionary entries
         >>> del obj.y  # Delete dictionary entries
         >>> obj.save()  # Manually save changes to the JSON file
+
+        >>> with PerDict('file.json', autosave='batched') as obj:
+        ...     for i in range(1000):
+        ...         obj[str(i)] = i  # Written at most once per second and on exit
+
+        >>> with obj.batch():
+        ...     for i in range(1000):
+        ...         obj[str(i)] = i  # Written once when the block ends
+
+    With `wal=True` every change is appended as a single JSON line to '<path>.log'. The JSON
+    file is only rewritten (and the log truncated) by `save()`, or automatically once the log
+    grows past twice the size of the JSON file unless autosave is False. The log is only
+    supported with the JSON format and without shards. Shards cannot be used with `keep_open`
+    or 'async' autosave either.
+
+    When orjson is installed it is used for the JSON format, and it saves NaN and infinities as null.
     """
 
-    __slots__ = "autosave", "path"
+    __slots__ = (
+        "autosave", "flush_interval", "durable", "format", "shards", "_dumps", "_loads",
+        "_path", "_path_str", "_tmp_path", "_fd", "_dirty", "_last_flush", "_last_digest",
+        "_log", "_log_path", "_log_size", "_log_end", "_pending", "_unsynced_size", "_snapshot_size",
+        "_lock", "_writer", "_wake", "_error",
+        "_shard_keys", "_shard_paths", "_shard_digests", "_dirty_shards", "_stale_shards",
+        "__weakref__",
+    )
 
-    def __init__(self, path: str, autosave: bool = True, **defaults: Any) -> None:
+    def __init__(
+            self,
+            path: Union[str, 'os.PathLike[str]'],
+            autosave: Union[bool, str] = True,
+            # Not a plain float, for which mypyc adds a hidden argument that mypyc 2.4 fails on
+            flush_interval: Union[int, float] = 1.0,
+            wal: bool = False,
+            durable: bool = False,
+            keep_open: bool = False,
+            format: Optional[str] = None,
+            shards: Optional[int] = None,
+            **defaults: Any,
+    ) -> None:
         """
         Initialize a PerDict object.
 
         Args:
             path (str): The path to the JSON file.
-            autosave (bool, optional): Whether to automatically save changes to the file (default is True).
+            autosave (bool | str, optional): When to save changes to the file (default is True).
+            flush_interval (float, optional): Minimum number of seconds between batched saves (default is 1.0).
+            wal (bool, optional): Whether to append changes to a write-ahead log (default is False).
+            durable (bool, optional): Whether to sync every write to stable storage (default is False).
+            keep_open (bool, optional): Whether to keep the JSON file open between saves (default is False).
+            format (str, optional): The file format, 'json' or 'msgpack' (default is based on the extension).
+            shards (int, optional): The number of shard files (default is None).
             **defaults: Default key-value pairs to initialize the dictionary.
+
+        Raises:
+            ValueError: If autosave or format is not supported, wal is used with MessagePack, or
+                shards is not positive, used with wal, keep_open or 'async' autosave, or path is a file.
+            ImportError: If format is 'msgpack' and msgpack is not installed.
         """
         super().__init__()
 
+        if autosave not in _AUTOSAVE_MODES:
+            raise ValueError(f"autosave must be one of {_AUTOSAVE_MODES}, got {autosave!r}")
+
+        path = os.fspath(path)
+        if format is None:
+            format = 'msgpack' if path.endswith(_MSGPACK_SUFFIXES) else 'json'
+        if format not in _FORMATS:
+            raise ValueError(f"format must be one of {tuple(_FORMATS)}, got {format!r}")
+        if format == 'msgpack':
+            if msgpack is None:
+                raise ImportError("format='msgpack' requires the msgpack package")
+            if wal:
+                raise ValueError("wal is only supported with format='json'")
+        if shards is not None:
+            if shards < 1:
+                raise ValueError(f"shards must be a positive integer, got {shards!r}")
+            if wal or keep_open or autosave == 'async':
+                # The 'async' writer would read the shards while a change is half applied
+                raise ValueError("shards cannot be combined with wal, keep_open or autosave='async'")
+
+        self.format = format
+        self.shards = shards
+        self._dumps, self._loads = _FORMATS[format]
         self.autosave = autosave
-        self.path = Path(path)
-        self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.path.touch()
+        self.flush_interval = flush_interval
+        self.durable = durable
+        # Only set once loading succeeded, so __del__ never saves over a file that failed to parse
+        self._dirty = False
+        self._last_flush = float('-inf')
+        self._lock = threading.RLock()
+        self._writer: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._error: Optional[Exception] = None
+        # Plain strings are cheaper to pass to os functions than Path objects
+        self._path: Optional[Path] = None
+        self._path_str = path
+        self._tmp_path = self._path_str + '.tmp'
+        self._log_path = self._path_str + '.log'
+        self._fd: Optional[int] = None
+        self._log: Optional[BinaryIO] = None
+        self._log_size = 0
+        # Bytes of the log already in the file
+        self._log_end = 0
+        # Log records not written yet. They reach the file in one write on the next flush, and
+        # never without one, so autosave=False keeps changes in memory like it does without the log.
+        self._pending = bytearray()
+        self._unsynced_size = 0
+        self._last_digest: Optional[bytes] = None
+        self._shard_keys: Optional[list[dict]] = None
+        self._shard_paths: list[str] = []
+        self._shard_digests: list[Optional[bytes]] = []
+        self._dirty_shards: set[int] = set()
+        self._stale_shards: list[str] = []
+
+        if shards is None:
+            self._open_file(keep_open)
+        else:
+            self._open_shards(shards)
 
-        if self.path.stat().st_size != 0:
-            with open(self.path, 'r') as f:
-                data = json.load(f)
-                dict.update(self, data)
+        replayed = self._replay_log()
+        if shards is not None:
+            self._index_shards(shards)
+        if wal:
+            # Unbuffered, as flush() hands the pending records to the file in one write
+            self._log = open(self._log_path, 'ab', buffering=0)
+            self._log_size = self._log_end = self._log.tell()
+        elif replayed:
+            # A log left behind by a previous wal=True session is folded into the JSON file
+            self._save(None, False)
+            os.remove(self._log_path)
 
         self.set_defaults(defaults)
-        self._autosave()
+        self._mark_dirty()
+        _instances[id(self)] = self
+
+    # Property setters are not supported in classes mypyc does not compile as native
+    path = property(_get_path, _set_path)
 
     def set_defaults(self, defaults: dict):
-        for k, v in defaults.items():
-            dict.setdefault(self, k, v)
+        missing = {k: v for k, v in defaults.items() if k not in self}
+        if missing:
+            _dict_update(self, missing)
+            self._append_op('set', missing)
+
+    def _open_file(self, keep_open: bool) -> None:
+        """
+        Load the JSON file, creating it and its directory if they are missing.
+
+        Opening with O_CREAT creates a missing file and returns the descriptor to read from in one
+        call. With `keep_open` the same descriptor is kept for saving.
+
+        Args:
+            keep_open: Whether to keep the file open for saving.
+        """
+        flags = (os.O_RDWR if keep_open else os.O_RDONLY) | os.O_CREAT | _O_BINARY
+        try:
+            fd = os.open(self._path_str, flags, 0o644)
+        except FileNotFoundError:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self._path_str, flags, 0o644)
+
+        try:
+            self._snapshot_size = os.fstat(fd).st_size
+            self._last_digest = self._load(fd, self._snapshot_size)
+        except BaseException:
+            os.close(fd)
+            raise
+
+        if keep_open:
+            self._fd = fd
+        else:
+            os.close(fd)
+
+    def _open_shards(self, shards: int) -> None:
+        """
+        Load every shard file in the directory, creating the directory if it is missing.
+
+        Shard files numbered past `shards`, left behind by an earlier session with more shards,
+        are loaded as well and removed once all shards have been rewritten.
+
+        Args:
+            shards: The number of shard files.
+        """
+        try:
+            os.makedirs(self._path_str, exist_ok=True)
+        except FileExistsError:
+            raise ValueError(
+                f"shards needs path to be a directory, but {self._path_str!r} is a file"
+            ) from None
+        suffix = _SHARD_SUFFIXES[self.format]
+        self._snapshot_size = 0
+        self._shard_paths = [os.path.join(self._path_str, f'{i:03d}{suffix}') for i in range(shards)]
+        self._shard_digests = [None] * shards
+
+        for name in os.listdir(self._path_str):
+            stem, _, ext = name.partition('.')
+            if '.' + ext != suffix or not stem.isdigit():
+                continue
+
+            path = os.path.join(self._path_str, name)
+            fd = os.open(path, os.O_RDONLY | _O_BINARY)
+            try:
+                digest = self._load(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
 
-    def _autosave(self) -> None:
+            i = int(stem)
+            if i < shards:
+                self._shard_digests[i] = digest
+            else:
+                self._stale_shards.append(path)
+
+    def _index_shards(self, shards: int) -> None:
+        """
+        Assign every key to its shard and mark all shards for rewriting.
+
+        Args:
+            shards: The number of shard files.
+        """
+        shard_keys: list[dict] = [{} for _ in range(shards)]
+        for key in self:
+            shard_keys[_shard_of(key, shards)][key] = None
+        self._shard_keys = shard_keys
+        self._dirty_shards = set(range(shards))
+
+    def _load(self, fd: int, size: int) -> Optional[bytes]:
+        """
+        Update the dictionary from the serialized contents of an open file.
+
+        Args:
+            fd: The file descriptor to read from.
+            size: The size of the file.
+
+        Returns:
+            bytes | None: The digest of the contents, or None if the file is empty.
         """
-        Save the dictionary to the JSON file if autosave is enabled.
+        if size > _MMAP_MIN_SIZE:
+            # Parse large files in place rather than copying them into memory first
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                _dict_update(self, self._loads(view))
+                return _digest(view)
+
+        if size == 0:
+            return None
+
+        buf = os.read(fd, size)
+        _dict_update(self, self._loads(buf))
+        return _digest(buf)
+
+    def _replay_log(self) -> bool:
         """
-        if self.autosave:
-            self.save()
+        Apply the operations stored in the write-ahead log, if there is one.
+
+        Returns:
+            bool: Whether any operation was applied.
+        """
+        try:
+            with open(self._log_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+
+        lines = data.split(b'\n')
+        if lines[-1]:
+            # The final append was interrupted. The partial record is cut off so new records are
+            # not appended to it.
+            with open(self._log_path, 'r+b') as f:
+                f.truncate(len(data) - len(lines[-1]))
+
+        for line in lines[:-1]:
+            entry = _loads(line)
+            op = entry['op']
+            if op == 'set':
+                _dict_update(self, entry['d'])
+            elif op == 'del':
+                for k in entry['d']:
+                    _dict_pop(self, k, None)
+            elif op == 'clear':
+                _dict_clear(self)
+
+        return len(lines) > 1
+
+    def _append_op(self, op: str, data: Any = None) -> None:
+        """
+        Append an operation to the write-ahead log if it is enabled, and mark the shards it
+        touches for rewriting if the dictionary is sharded.
+
+        Keys are stored as JSON object keys so they round-trip exactly like the JSON file.
+
+        Args:
+            op: The operation name, one of 'set', 'del' or 'clear'.
+            data: The items to set, or the keys to delete mapped to None.
+        """
+        shard_keys = self._shard_keys
+        if shard_keys is not None:
+            self._index_op(shard_keys, op, data)
+
+        if self._log is None:
+            return
+
+        entry: dict[str, Any] = {'op': op} if data is None else {'op': op, 'd': data}
+        record = _dumps(entry)
+        # Two appends to the reused buffer instead of concatenating a new bytes object per record
+        self._pending += record
+        self._pending += b'\n'
+        size = len(record) + 1
+        self._log_size += size
+        self._unsynced_size += size
+
+        if self.autosave and self._log_size > max(2 * self._snapshot_size, _COMPACT_MIN_SIZE):
+            self._save(None, False)
+
+    def _index_op(self, shard_keys: list[dict], op: str, data: Any) -> None:
+        """
+        Update the keys of the shards touched by an operation and mark them for rewriting.
+
+        Args:
+            shard_keys: The keys stored in each shard.
+            op: The operation name, one of 'set', 'del' or 'clear'.
+            data: The items to set, or the keys to delete mapped to None.
+        """
+        shards = len(self._shard_paths)
+        if op == 'clear':
+            for keys in shard_keys:
+                keys.clear()
+            self._dirty_shards.update(range(shards))
+            return
+
+        for key in data:
+            i = _shard_of(key, shards)
+            if op == 'set':
+                shard_keys[i][key] = None
+            else:
+                shard_keys[i].pop(key, None)
+            self._dirty_shards.add(i)
+
+    def _mark_dirty(self) -> None:
+        """
+        Mark the dictionary as changed and save it according to the autosave mode.
+        """
+        self._dirty = True
+        autosave = self.autosave
+        if autosave == 'batched':
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+        elif autosave == 'async':
+            writer = self._writer
+            if writer is None or not writer.is_alive():
+                self._start_writer()
+            self._wake.set()
+            self._raise_writer_error()
+        elif autosave:
+            self.flush()
+
+    def _start_writer(self) -> None:
+        """
+        Start the background thread that saves the dictionary in 'async' autosave mode.
+        """
+        self._wake = threading.Event()
+        writer = threading.Thread(
+            target=_write_in_background,
+            args=(weakref.ref(self), self._wake),
+            name=f'{type(self).__name__}-writer',
+            daemon=True,
+        )
+        self._writer = writer
+        writer.start()
+
+    def _stop_writer(self) -> None:
+        """
+        Stop the background writer thread, waiting for a save in progress to finish.
+        """
+        writer, self._writer = self._writer, None
+        if writer is None:
+            return
+
+        self._wake.set()
+        # The writer drops the last reference itself when the dictionary is collected there
+        if writer is not threading.current_thread():
+            writer.join()
+
+    def _raise_writer_error(self) -> None:
+        """
+        Raise the error of the last failed save on the 'async' writer thread, if there is one.
+        """
+        error = self._error
+        if error is not None:
+            self._error = None
+            raise error
 
     def __enter__(self) -> 'PerDict':
         """
@@ -73,9 +705,28 @@ class PerDict(dict):
 
     def __exit__(self, exc_type, exc_value, traceback) -> None:
         """
-        Exit the context manager and save the dictionary.
+        Exit the context manager and save any unsaved changes.
+        """
+        self.flush()
+
+    @contextmanager
+    def batch(self) -> Iterator['PerDict']:
+        """
+        Suspend autosave for the duration of a 'with' block and save once when it ends.
+
+        The changes are only saved at the end if autosave was enabled. With autosave False the
+        block changes nothing, and the changes still wait for `save()` or `flush()`.
+
+        Yields:
+            PerDict: The dictionary itself.
         """
-        self.save()
+        autosave, self.autosave = self.autosave, False
+        try:
+            yield self
+        finally:
+            self.autosave = autosave
+            if autosave:
+                self.flush()
 
     def __setitem__(self, key: _KT, value: _VT) -> None:
         """
@@ -85,8 +736,9 @@ class PerDict(dict):
             key: The key to set.
             value: The value to assign to the key.
         """
-        dict.__setitem__(self, key, value)
-        self._autosave()
+        _dict_setitem(self, key, value)
+        self._append_op('set', {key: value})
+        self._mark_dirty()
 
     def __delitem__(self, key: _KT) -> None:
         """
@@ -95,8 +747,9 @@ class PerDict(dict):
         Args:
             key: The key to delete.
         """
-        dict.__delitem__(self, key)
-        self._autosave()
+        _dict_delitem(self, key)
+        self._append_op('del', {key: None})
+        self._mark_dirty()
 
     def __repr__(self) -> str:
         """
@@ -105,19 +758,217 @@ class PerDict(dict):
         r = dict.__repr__(self)
         return f'{type(self).__name__}({r})'
 
-    def save(self, data: dict = None) -> None:
+    def save(self, data: Optional[dict] = None) -> None:
         """
-        Save the dictionary to the JSON file.
+        Save the dictionary to the JSON file, or to every shard, and truncate the write-ahead log.
+
+        Unlike `flush()`, this always rewrites the file, even if it was saved unchanged before, so
+        it also restores a file deleted or edited outside the dictionary.
+        """
+        self._save(data, True)
+
+    def _save(self, data: Optional[dict], force: bool) -> None:
+        """
+        Save the dictionary to the JSON file, or its changed shards, and truncate the write-ahead log.
+
+        Args:
+            data: Items to update the dictionary with first.
+            force: Whether to rewrite the files even if their contents did not change.
+        """
+        with self._lock:
+            shard_keys = self._shard_keys
+            if data is not None:
+                _dict_update(self, data)
+                if shard_keys is not None:
+                    self._index_op(shard_keys, 'set', data)
+
+            # Cleared before serializing so changes made meanwhile by another thread are not lost
+            self._dirty = False
+
+            try:
+                if shard_keys is not None:
+                    self._save_shards(shard_keys, force)
+                else:
+                    # Serialize up front so the file gets a single write() instead of one per JSON
+                    # token. The C serializers hold the GIL throughout, so this is safe against changes
+                    # from other threads as long as no Python code iterates the dictionary here.
+                    buf = self._dumps(self)
+                    digest = _digest(buf)
+                    if force or digest != self._last_digest:
+                        self._dump(buf)
+                        self._last_digest = digest
+                        self._snapshot_size = len(buf)
+            except BaseException:
+                # Saved again by the next flush
+                self._dirty = True
+                raise
+
+            if self._log is not None:
+                self._log.truncate(0)
+                self._log_end = 0
+                self._pending.clear()
+                self._log_size = 0
+                self._unsynced_size = 0
+
+            self._last_flush = time.monotonic()
+
+    def _save_shards(self, shard_keys: list[dict], force: bool) -> None:
+        """
+        Rewrite the shard files whose keys changed since the last save.
+
+        Args:
+            shard_keys: The keys stored in each shard.
+            force: Whether to rewrite every shard file, changed or not.
+        """
+        if force:
+            self._dirty_shards.update(range(len(shard_keys)))
+        dirty, self._dirty_shards = self._dirty_shards, set()
+        full = len(dirty) == len(shard_keys)
+        try:
+            for i in sorted(dirty):
+                buf = self._dumps({k: _dict_getitem(self, k) for k in shard_keys[i]})
+                digest = _digest(buf)
+                if force or digest != self._shard_digests[i]:
+                    path = self._shard_paths[i]
+                    self._replace(path, path + '.tmp', buf)
+                    self._shard_digests[i] = digest
+                dirty.discard(i)
+        except BaseException:
+            # The shards not written yet are saved next time
+            self._dirty_shards.update(dirty)
+            raise
+
+        if self._stale_shards and full:
+            # Every key has been written to its current shard, so the leftover files can go
+            for path in self._stale_shards:
+                os.remove(path)
+            self._stale_shards = []
+
+    def _dump(self, buf: bytes) -> None:
+        """
+        Replace the contents of the JSON file with the serialized dictionary.
+
+        The data is written to a temporary file which is then renamed over the JSON file, so a
+        crash mid-write never leaves a truncated file behind. With `keep_open` the already open
+        file is overwritten in place instead.
+
+        Args:
+            buf: The serialized dictionary.
+        """
+        fd = self._fd
+        if fd is not None:
+            os.lseek(fd, 0, os.SEEK_SET)
+            _write_all(fd, buf)
+            os.ftruncate(fd, len(buf))
+            if self.durable:
+                _sync(fd)
+            return
+
+        self._replace(self._path_str, self._tmp_path, buf)
+
+    def _replace(self, path: str, tmp_path: str, buf: bytes) -> None:
+        """
+        Atomically replace the contents of a file by writing a temporary file and renaming it.
+
+        Args:
+            path: The file to replace.
+            tmp_path: The temporary file to write first.
+            buf: The new contents.
+        """
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | _O_BINARY, 0o644)
+        try:
+            if self.durable and hasattr(os, 'posix_fallocate') and buf:
+                # Reserve the blocks up front so the sync does not also wait on block allocation
+                os.posix_fallocate(fd, 0, len(buf))
+            _write_all(fd, buf)
+            if self.durable:
+                _sync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(tmp_path, path)
+
+        if self.durable and os.name == 'posix':
+            # Persist the rename itself
+            dir_fd = os.open(os.path.dirname(path) or os.curdir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def close(self) -> None:
+        """
+        Save any unsaved changes, stop the 'async' writer thread and close the files kept open by
+        `keep_open` and `wal`.
+
+        The dictionary stays usable afterwards, saving by replacing the whole JSON file.
+        """
+        self._stop_writer()
+        if self._log is not None:
+            # Later saves no longer truncate the log, so it is compacted now instead of being
+            # replayed over them on the next load
+            self._save(None, False)
+        else:
+            self.flush()
+        self._close_files()
+        self._raise_writer_error()
+
+    def _close_files(self) -> None:
+        """
+        Close the files kept open by `keep_open` and `wal`.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __del__(self) -> None:
+        """
+        Close the open files, saving any unsaved changes if autosave is enabled.
         """
+        try:
+            self._stop_writer()
+            if self.autosave:
+                self.flush()
+            self._close_files()
+        except AttributeError:
+            # __init__ did not get far enough to set every attribute
+            pass
 
-        if data is not None:
-            for k, v in data.items():
-                self[k] = v
+    def flush(self) -> None:
+        """
+        Save any unsaved changes, either to the write-ahead log or to the JSON file.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
 
-        with open(self.path, 'w') as f:
-            json.dump(self, f)
+            if self._log is None:
+                self._save(None, False)
+            else:
+                self._dirty = False
+                # Copied and removed separately so records appended meanwhile by another thread
+                # stay pending, and only removed once written so a failed write is retried
+                pending = bytes(self._pending)
+                fd = self._log.fileno()
+                try:
+                    _write_all(fd, pending)
+                except BaseException:
+                    self._dirty = True
+                    # Cut off a partly written record, which the retry would otherwise extend
+                    os.ftruncate(fd, self._log_end)
+                    raise
+                del self._pending[:len(pending)]
+                self._log_end += len(pending)
+                if self.durable or self._unsynced_size >= _LOG_BYTES_PER_SYNC:
+                    _sync(self._log.fileno())
+                    self._unsynced_size = 0
+                self._last_flush = time.monotonic()
 
-    def update(self, __m, **kwargs: _VT) -> None:
+    def update(self, __m, **kwargs: Any) -> None:  # type: ignore[override]
         """
         Update the dictionary with key-value pairs from another dictionary.
 
@@ -125,17 +976,33 @@ class PerDict(dict):
             __m: The dictionary-like object to update from.
             **kwargs: Additional key-value pairs to update with.
         """
-        dict.update(self, __m, **kwargs)
-        self._autosave()
+        if self._log is not None or self._shard_keys is not None:
+            __m = dict(__m, **kwargs)
+            kwargs = {}
+
+        _dict_update(self, __m, **kwargs)
+        self._append_op('set', __m)
+        self._mark_dirty()
+
+    def __ior__(self, other) -> 'PerDict':  # type: ignore[misc]
+        """
+        Update the dictionary in place using the '|=' operator, saving once.
+
+        Args:
+            other: The dictionary-like object or iterable of pairs to update from.
+        """
+        self.update(other)
+        return self
 
     def clear(self) -> None:
         """
         Clear all items from the dictionary.
         """
-        dict.clear(self)
-        self._autosave()
+        _dict_clear(self)
+        self._append_op('clear')
+        self._mark_dirty()
 
-    def pop(self, key: _KT, default: _VT = ...) -> _VT:
+    def pop(self, key: _KT, default: _VT = ...) -> _VT:  # type: ignore[assignment]
         """
         Remove and return the value associated with a key.
 
@@ -149,8 +1016,9 @@ class PerDict(dict):
         Raises:
             KeyError: If the key is not found and no default value is provided.
         """
-        result = dict.pop(self, key, default)
-        self._autosave()
+        result = _dict_pop(self, key, default)
+        self._append_op('del', {key: None})
+        self._mark_dirty()
         return result
 
     def popitem(self) -> tuple[_KT, _VT]:
@@ -160,11 +1028,12 @@ class PerDict(dict):
         Returns:
             tuple[_KT, _VT]: The removed (key, value) pair.
         """
-        result = dict.popitem(self)
-        self._autosave()
-        return result
+        result = _dict_popitem(self)
+        self._append_op('del', {result[0]: None})
+        self._mark_dirty()
+        return result  # type: ignore[return-value]
 
-    def setdefault(self, key: _KT, default: _VT = ...) -> _VT:
+    def setdefault(self, key: _KT, default: _VT = ...) -> _VT:  # type: ignore[assignment]
         """
         Set a key to a default value if it does not exist in the dictionary.
 
@@ -175,8 +1044,10 @@ class PerDict(dict):
         Returns:
             _VT: The existing or newly set value associated with the key.
         """
-        result = dict.setdefault(self, key, default)
-        if result == default:
-            self._autosave()
+        if key in self:
+            return _dict_getitem(self, key)
 
-        return result
+        _dict_setitem(self, key, default)
+        self._append_op('set', {key: default})
+        self._mark_dirty()
+        return default
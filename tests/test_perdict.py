@@ -1,11 +1,20 @@
 import os
 import json
+import gc
+import math
+import time
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import pytest
 
-from src.perdict import PerDict
+import src.perdict
+from src.perdict import PerDict, _flush_at_exit
+
+# Code compiled with PERDICT_MYPYC=1 binds module globals at import, so patching them has no effect
+patches_globals = pytest.mark.skipif(
+    not src.perdict.__file__.endswith(".py"), reason="module globals cannot be patched when compiled"
+)
 
 
 @pytest.fixture
@@ -94,3 +103,414 @@ def test_setdefault_no_autosave(temp_perdict):
     with open(temp_perdict.path, "r") as f:
         data = json.load(f)
         assert "key7" not in data
+
+
+def test_batched_autosave_coalesces_writes(temp_perdict):
+    temp_perdict = PerDict(temp_perdict.path, autosave="batched", flush_interval=60)
+    for i in range(10):
+        temp_perdict[f"key{i}"] = i
+
+    with open(temp_perdict.path, "r") as f:
+        data = json.load(f)
+        assert "key0" not in data
+
+    temp_perdict.flush()
+
+    with open(temp_perdict.path, "r") as f:
+        data = json.load(f)
+        assert data["key9"] == 9
+
+
+def test_batched_autosave_context_manager(temp_perdict):
+    with PerDict(temp_perdict.path, autosave="batched", flush_interval=60) as pd:
+        pd["key8"] = "value8"
+
+    with open(temp_perdict.path, "r") as f:
+        data = json.load(f)
+        assert data["key8"] == "value8"
+
+
+def test_invalid_autosave(temp_perdict):
+    with pytest.raises(ValueError):
+        PerDict(temp_perdict.path, autosave="sometimes")
+
+
+def test_wal_appends_to_log(temp_perdict):
+    pd = PerDict(temp_perdict.path, wal=True)
+    pd["key1"] = "value1"
+    pd.update({"key2": "value2"}, key3="value3")
+    del pd["key2"]
+
+    with open(pd.path, "r") as f:
+        assert "key1" not in json.load(f)
+
+    reloaded = PerDict(temp_perdict.path, wal=True)
+    assert reloaded == {"key1": "value1", "key3": "value3"}
+
+
+def test_wal_save_compacts_log(temp_perdict):
+    pd = PerDict(temp_perdict.path, wal=True)
+    pd["key1"] = "value1"
+    pd.save()
+
+    with open(pd.path, "r") as f:
+        assert json.load(f) == {"key1": "value1"}
+    assert os.path.getsize(f"{pd.path}.log") == 0
+
+
+def test_wal_log_folded_without_wal(temp_perdict):
+    pd = PerDict(temp_perdict.path, wal=True)
+    pd["key1"] = "value1"
+    pd.clear()
+    pd[1] = "one"
+
+    reloaded = PerDict(temp_perdict.path)
+    assert reloaded == {"1": "one"}
+    assert not os.path.exists(f"{pd.path}.log")
+
+    with open(pd.path, "r") as f:
+        assert json.load(f) == {"1": "one"}
+
+
+def test_roundtrip_values(temp_perdict):
+    temp_perdict.update({1: "int key", "big": 2 ** 70, "nested": {"list": [1.5, None, True]}})
+
+    reloaded = PerDict(temp_perdict.path)
+    assert reloaded == {"1": "int key", "big": 2 ** 70, "nested": {"list": [1.5, None, True]}}
+
+
+def test_durable_save(temp_perdict):
+    pd = PerDict(temp_perdict.path, durable=True)
+    pd["key1"] = "value1"
+
+    with open(pd.path, "r") as f:
+        assert json.load(f) == {"key1": "value1"}
+
+    pd = PerDict(temp_perdict.path, wal=True, durable=True)
+    pd["key2"] = "value2"
+    assert PerDict(temp_perdict.path) == {"key1": "value1", "key2": "value2"}
+
+
+def test_save_replaces_file_atomically(temp_perdict):
+    temp_perdict["key1"] = "value1"
+
+    assert os.listdir(temp_perdict.path.parent) == ["test.json"]
+    with open(temp_perdict.path, "r") as f:
+        assert json.load(f) == {"key1": "value1"}
+
+
+def test_unchanged_save_skips_write(temp_perdict):
+    temp_perdict["key1"] = "value1"
+    inode = os.stat(temp_perdict.path).st_ino
+
+    temp_perdict["key1"] = "value1"
+    temp_perdict.update({})
+    temp_perdict.flush()
+    PerDict(temp_perdict.path)
+
+    assert os.stat(temp_perdict.path).st_ino == inode
+
+
+def test_save_restores_deleted_file(temp_perdict):
+    temp_perdict["key1"] = "value1"
+    os.remove(temp_perdict.path)
+    temp_perdict.save()
+
+    with open(temp_perdict.path, "r") as f:
+        assert json.load(f) == {"key1": "value1"}
+
+
+def test_setdefault_unequal_default(temp_perdict):
+    temp_perdict.setdefault("key1", float("nan"))
+
+    with open(temp_perdict.path, "r") as f:
+        assert "key1" in json.load(f)
+
+
+def test_load_large_file(temp_perdict):
+    data = {f"key{i}": "x" * 100 for i in range(1000)}
+    temp_perdict.update(data)
+
+    assert os.path.getsize(temp_perdict.path) > 64 * 1024
+    assert PerDict(temp_perdict.path) == data
+
+
+def test_creates_missing_directories(temp_perdict):
+    path = temp_perdict.path.parent / "a" / "b" / "test.json"
+    PerDict(path, autosave=False)
+
+    assert path.exists()
+
+
+def test_keep_open(temp_perdict):
+    pd = PerDict(temp_perdict.path, keep_open=True)
+    pd["key1"] = "a" * 100
+    pd["key1"] = "b"
+
+    with open(pd.path, "r") as f:
+        assert json.load(f) == {"key1": "b"}
+
+    pd.close()
+    pd["key2"] = "c"
+    assert PerDict(temp_perdict.path) == {"key1": "b", "key2": "c"}
+
+
+def test_close_flushes_batched(temp_perdict):
+    pd = PerDict(temp_perdict.path, autosave="batched", flush_interval=60, wal=True)
+    pd["key1"] = "value1"
+    pd.close()
+
+    assert PerDict(temp_perdict.path) == {"key1": "value1"}
+
+
+def test_batch(temp_perdict):
+    with temp_perdict.batch() as pd:
+        for i in range(10):
+            pd[f"key{i}"] = i
+
+        with open(temp_perdict.path, "r") as f:
+            assert json.load(f) == {}
+
+    assert temp_perdict.autosave
+    with open(temp_perdict.path, "r") as f:
+        assert json.load(f) == {f"key{i}": i for i in range(10)}
+
+
+def test_ior(temp_perdict):
+    temp_perdict |= {"key1": "value1"}
+    temp_perdict |= [("key2", "value2")]
+
+    assert isinstance(temp_perdict, PerDict)
+    with open(temp_perdict.path, "r") as f:
+        assert json.load(f) == {"key1": "value1", "key2": "value2"}
+
+
+def test_msgpack_format(temp_perdict):
+    msgpack = pytest.importorskip("msgpack")
+    path = temp_perdict.path.with_suffix(".mpk")
+
+    pd = PerDict(path)
+    pd.update({1: 2.5, "key": [1, 2, 3]})
+
+    assert pd.format == "msgpack"
+    with open(path, "rb") as f:
+        assert msgpack.unpackb(f.read(), strict_map_key=False) == {1: 2.5, "key": [1, 2, 3]}
+    assert PerDict(path) == {1: 2.5, "key": [1, 2, 3]}
+
+
+def test_invalid_format(temp_perdict):
+    with pytest.raises(ValueError):
+        PerDict(temp_perdict.path, format="yaml")
+
+
+def test_compact_utf8_output(temp_perdict):
+    temp_perdict.update({"key1": "välue", "key2": [1, 2]})
+
+    with open(temp_perdict.path, "rb") as f:
+        assert f.read() == '{"key1":"välue","key2":[1,2]}'.encode()
+
+
+def test_async_autosave(temp_perdict):
+    pd = PerDict(temp_perdict.path, autosave="async")
+    for i in range(100):
+        pd[f"key{i}"] = i
+
+    writer = pd._writer
+    pd.close()
+
+    assert not writer.is_alive()
+    assert PerDict(temp_perdict.path) == {f"key{i}": i for i in range(100)}
+
+
+def test_setdefault_existing_key_not_logged(temp_perdict):
+    pd = PerDict(temp_perdict.path, wal=True)
+    pd["key1"] = [1, 2]
+    size = os.path.getsize(f"{pd.path}.log")
+
+    assert pd.setdefault("key1", [1, 2]) == [1, 2]
+    assert os.path.getsize(f"{pd.path}.log") == size
+
+
+def test_wal_buffers_until_flush(temp_perdict):
+    pd = PerDict(temp_perdict.path, autosave=False, wal=True)
+    for i in range(1000):
+        pd[str(i)] = i
+    assert os.path.getsize(f"{pd.path}.log") == 0
+
+    pd.flush()
+    assert os.path.getsize(f"{pd.path}.log") > 8192
+
+
+def test_shards_roundtrip(temp_perdict):
+    path = f"{temp_perdict.path}.d"
+    pd = PerDict(path, shards=4)
+    pd.update({str(i): i for i in range(100)})
+    del pd["0"]
+    pd.pop("1")
+    pd[True] = None
+
+    assert sorted(os.listdir(path)) == ["000.json", "001.json", "002.json", "003.json"]
+    reloaded = PerDict(path, shards=4)
+    assert reloaded == {**{str(i): i for i in range(2, 100)}, "true": None}
+
+
+def test_shards_rewrite_only_changed_shard(temp_perdict):
+    path = f"{temp_perdict.path}.d"
+    pd = PerDict(path, shards=4)
+    pd.update({str(i): i for i in range(100)})
+    inodes = {name: os.stat(os.path.join(path, name)).st_ino for name in os.listdir(path)}
+
+    pd["5"] = "five"
+    changed = [name for name in inodes if os.stat(os.path.join(path, name)).st_ino != inodes[name]]
+    assert len(changed) == 1
+
+    with open(os.path.join(path, changed[0]), "r") as f:
+        assert json.load(f)["5"] == "five"
+
+
+def test_shards_resharded(temp_perdict):
+    path = f"{temp_perdict.path}.d"
+    pd = PerDict(path, shards=8)
+    pd.update({str(i): i for i in range(100)})
+
+    resharded = PerDict(path, shards=2)
+    del resharded["0"]
+    assert sorted(os.listdir(path)) == ["000.json", "001.json"]
+    assert PerDict(path, shards=2) == {str(i): i for i in range(1, 100)}
+
+
+def test_invalid_shards(temp_perdict):
+    with pytest.raises(ValueError):
+        PerDict(f"{temp_perdict.path}.d", shards=0)
+    with pytest.raises(ValueError):
+        PerDict(f"{temp_perdict.path}.d", shards=4, wal=True)
+    with pytest.raises(ValueError):
+        PerDict(f"{temp_perdict.path}.d", shards=4, autosave="async")
+    with pytest.raises(ValueError):
+        PerDict(temp_perdict.path, shards=4)
+
+
+def test_failed_load_keeps_file(temp_perdict):
+    with open(temp_perdict.path, "w") as f:
+        f.write('{"a": 1, "b": ')
+
+    with pytest.raises(ValueError):
+        PerDict(temp_perdict.path)
+    gc.collect()
+
+    with open(temp_perdict.path, "r") as f:
+        assert f.read() == '{"a": 1, "b": '
+
+
+def test_wal_close_compacts_log(temp_perdict):
+    pd = PerDict(temp_perdict.path, wal=True)
+    pd["key1"] = "value1"
+    pd.close()
+    del pd["key1"]
+
+    assert PerDict(temp_perdict.path) == {}
+
+
+@patches_globals
+def test_non_finite_floats_roundtrip_without_orjson(temp_perdict, monkeypatch):
+    monkeypatch.setattr("src.perdict.orjson", None)
+    temp_perdict.update({"nan": float("nan"), "inf": [float("inf"), float("-inf")], "none": None})
+
+    reloaded = PerDict(temp_perdict.path)
+    assert math.isnan(reloaded["nan"])
+    assert reloaded["inf"] == [float("inf"), float("-inf")]
+    assert reloaded["none"] is None
+
+
+def test_async_autosave_recovers_from_error(temp_perdict):
+    pd = PerDict(temp_perdict.path, autosave="async")
+    pd["key1"] = object()
+    deadline = time.monotonic() + 5
+    while pd._error is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    with pytest.raises(TypeError):
+        pd["key1"] = "value1"
+    assert pd._writer.is_alive()
+
+    pd.close()
+    assert PerDict(temp_perdict.path) == {"key1": "value1"}
+
+
+def test_wal_autosave_off_keeps_changes_in_memory(temp_perdict):
+    pd = PerDict(temp_perdict.path, autosave=False, wal=True)
+    for i in range(10000):
+        pd[str(i)] = i
+    del pd
+    gc.collect()
+
+    assert PerDict(temp_perdict.path) == {}
+
+
+def test_wal_partial_record_dropped(temp_perdict):
+    pd = PerDict(temp_perdict.path, wal=True)
+    pd["key1"] = 1
+    pd.close()
+    with open(f"{pd.path}.log", "ab") as f:
+        f.write(b'{"op":"set","d":{"key2"')
+
+    pd = PerDict(temp_perdict.path, wal=True)
+    pd["key3"] = 3
+    pd.flush()
+    del pd
+
+    assert PerDict(temp_perdict.path, wal=True) == {"key1": 1, "key3": 3}
+
+
+def test_async_autosave_concurrent_changes(temp_perdict):
+    pd = PerDict(temp_perdict.path, autosave="async")
+    with pd.batch():
+        pd.update({f"key{i}": None for i in range(20000)})
+    for i in range(20000):
+        pd[f"new{i}"] = None
+        del pd[f"new{i}"]
+
+    pd.close()
+    assert PerDict(temp_perdict.path) == dict(pd)
+
+
+def test_flush_at_exit_continues_after_error(temp_perdict, capsys):
+    bad = PerDict(f"{temp_perdict.path}.bad", autosave="batched", flush_interval=60)
+    good = PerDict(temp_perdict.path, autosave="batched", flush_interval=60)
+    bad["key1"] = object()
+    good["key1"] = "value1"
+
+    _flush_at_exit()
+
+    assert "TypeError" in capsys.readouterr().err
+    with open(good.path, "r") as f:
+        assert json.load(f) == {"key1": "value1"}
+    del bad["key1"]
+
+
+@patches_globals
+def test_wal_failed_flush_keeps_records(temp_perdict, monkeypatch):
+    def write_half(fd, buf):
+        os.write(fd, buf[:len(buf) // 2])
+        raise OSError("disk full")
+
+    pd = PerDict(temp_perdict.path, autosave=False, wal=True)
+    pd["key1"] = "value1"
+    monkeypatch.setattr("src.perdict._write_all", write_half)
+    with pytest.raises(OSError):
+        pd.flush()
+    assert os.path.getsize(str(temp_perdict.path) + ".log") == 0
+
+    monkeypatch.undo()
+    pd.flush()
+    del pd
+    assert PerDict(temp_perdict.path) == {"key1": "value1"}
+
+
+def test_set_path(temp_perdict):
+    temp_perdict["key1"] = "value1"
+    temp_perdict.path = temp_perdict.path.with_name("moved.json")
+    temp_perdict["key1"] = "value1"
+
+    assert temp_perdict.path.name == "moved.json"
+    assert PerDict(temp_perdict.path) == {"key1": "value1"}